@@ -1,111 +1,273 @@
 # -*- coding: utf-8 -*-
 # jeroen.vanparidon@mpi.nl
 import os
+import io
 import zipfile
 import argparse
 import re
+import concurrent.futures
 from utensils import log_timer
 from lxml import etree
 import logging
 logging.basicConfig(format='[{levelname}] {message}', style='{', level=logging.INFO)
 
+# shared options for the iterparse calls in the strippers
+# recover is needed to deal with malformed XML in subs; skipping ID collection,
+# comments, and processing instructions cuts per-element allocations
+# (blank text nodes are only dropped in the upos/lemma strippers, because the
+# txt/viz formats need inter-element whitespace for text extraction)
+# note: an lxml parser built from these options is not thread-safe, so construct
+# one per worker rather than sharing a single instance
+XMLPARSE_OPTS = dict(recover=True, encoding='utf-8', collect_ids=False,
+                     remove_comments=True, remove_pis=True, huge_tree=False)
 
-def strip_upos(tree):
+
+def clear_elem(elem):
+    """Frees an element (and any preceding siblings) after parsing is done with it.
+
+    Keeps memory use proportional to a single sentence rather than the whole subtitle file.
+
+    :param elem: lxml element that has been fully parsed
+    """
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+
+def iter_elems(text, tag, **opts):
+    """Streams end-events for the given tag(s) out of a subtitle file.
+
+    Feeds the raw bytes to an XMLPullParser in 64 KiB slices, draining events
+    between slices so the tree never grows past a chunk's worth of sentences.
+    This skips the BytesIO wrapper and read-loop that iterparse would set up
+    per file; libxml2 parser contexts cannot outlive a document, so the pull
+    parser itself is still constructed per file.
+
+    :param text: bytes of the xml file
+    :param tag: tag or tags to report end-events for
+    :param opts: extra parser options, merged into XMLPARSE_OPTS
+    :returns: iterator over fully parsed elements
+    """
+    parser = etree.XMLPullParser(events=('end',), tag=tag, **XMLPARSE_OPTS, **opts)
+    for i in range(0, len(text), 1 << 16):
+        parser.feed(text[i:i + (1 << 16)])
+        for event, elem in parser.read_events():
+            yield elem
+    parser.close()
+    for event, elem in parser.read_events():
+        yield elem
+
+
+def strip_upos(text):
     # format [word]_[POS tag]
     stripped = []
-    for node in tree.iter():
-        if node.tag == 's':
-            stripped.append('\n')
+    for node in iter_elems(text, ('s', 'w'), remove_blank_text=True):
         if node.tag == 'w':
             stripped.append(f'{node.text}_{node.get("upos")} ')
+        elif node.tag == 's':
+            stripped.append('\n')
+            clear_elem(node)
     return u''.join(stripped)
 
 
-def strip_lemma(tree):
+def strip_lemma(text):
     # format [lemmatized word]
     stripped = []
-    for node in tree.iter():
-        if node.tag == 's':
-            stripped.append('\n')
+    for node in iter_elems(text, ('s', 'w'), remove_blank_text=True):
         if node.tag == 'w':
             stripped.append(f'{node.get("lemma")}_{node.get("upos")} ')
+        elif node.tag == 's':
+            stripped.append('\n')
+            clear_elem(node)
     return u''.join(stripped)
 
 
-def strip_txt(tree):
+# compiled fast path for the tagged formats, built with
+# `python setup.py build_ext --inplace`; the pure Python strippers
+# above stay as the fallback when the extension is not available
+try:
+    from strip_fast import strip_upos, strip_lemma  # noqa: F811
+except ImportError:
+    pass
+
+
+def strip_txt(text):
     """XML stripper method for raw text.
 
-    :param tree: lxml parse tree
+    :param text: bytes of the xml file to be stripped
     :returns: raw text
     """
     # format [sentence]
-    for node in tree.iter():
-        if node.tag == 'meta':
-            tree.remove(node)
-    return etree.tostring(tree, encoding=str, method='text')
+    # only emitting text for s elements implicitly skips the meta block,
+    # which the old tree-based version had to find and remove by mutation
+    stripped = []
+    for node in iter_elems(text, 's'):
+        stripped.append(''.join(node.itertext()))
+        stripped.append('\n')
+        clear_elem(node)
+    return u''.join(stripped)
 
 
-def strip_viz(tree):
+def strip_viz(text):
     # format [timestamp in ms] [sentence]
     stripped = []
-    for node in tree.iter():
-        if node.tag == 's':
-            children = list(node)
-            if len(children) > 0:
-                if children[0].tag == 'time':
-                    timestamp = children[0].get('value').replace(':', '').replace(',', '.')
-                    txt = etree.tostring(node, encoding=str, method='text').replace('\n', '')
-                    stripped.append(f'[{timestamp}] {txt}')
+    for node in iter_elems(text, 's'):
+        children = list(node)
+        if len(children) > 0:
+            if children[0].tag == 'time':
+                timestamp = children[0].get('value').replace(':', '').replace(',', '.')
+                txt = ''.join(node.itertext()).replace('\n', '')
+                stripped.append(f'[{timestamp}] {txt}')
+        clear_elem(node)
     return u'\n'.join(stripped)
 
 
-def strip_xml(text, xmlparser, ioformat='txt'):
+def strip_xml(text, ioformat='txt'):
     """Method for selecting xml stripper based on desired input/output format.
 
-    :param text: text to be stripped
-    :param xmlparser: lxml parser object
+    All strippers consume the raw bytes through iterparse so that memory use
+    stays proportional to a single sentence instead of the whole file.
+
+    :param text: bytes of the xml file to be stripped
     :param ioformat: desired input/output format
     :returns: stripped text
     """
-    tree = etree.fromstring(text, xmlparser)
     if ioformat == 'upos':
-        return strip_upos(tree)
+        return strip_upos(text)
     elif ioformat == 'lemma':
-        return strip_lemma(tree)
+        return strip_lemma(text)
     elif ioformat == 'txt':
-        return strip_txt(tree)
+        return strip_txt(text)
     elif ioformat == 'viz':
-        return strip_viz(tree)
+        return strip_viz(text)
+
+
+def _strip_worker(filepath, text, ioformat):
+    """Strips the xml from a single subtitle file inside a worker process.
+
+    :param filepath: path of the subtitle file inside the archive
+    :param text: bytes of the subtitle file
+    :param ioformat: desired input/output format
+    :returns: output path and xml-stripped text
+    """
+    try:
+        return filepath.replace('xml', ioformat), strip_xml(text, ioformat)
+    except etree.XMLSyntaxError as e:
+        # XMLSyntaxError carries an unpicklable libxml2 error log, so it can't
+        # cross the process boundary; re-raise as a picklable error that names
+        # the offending file instead of dying on an opaque pickling TypeError
+        raise ValueError(f'failed to parse {filepath}: {e}') from None
+
+
+def filter_filepaths(namelist, dirpath, lang, years, suffix):
+    """Selects archive members by directory, language, year range, and extension.
+
+    Paths inside the archive look like OpenSubtitles/{raw|parsed}/{lang}/{year}/...
+    so the year is sliced straight out at a fixed offset past the prefix instead
+    of splitting every path; entries that don't follow the layout are skipped.
+
+    :param namelist: member paths of the archive
+    :param dirpath: OpenSubtitles directory to include members from
+    :param lang: archive language
+    :param years: years to include members from
+    :param suffix: file extension to include members with
+    :returns: filtered member paths
+    """
+    y0, y1 = years
+    prefix = os.path.join(dirpath, lang) + '/'
+    start = len(prefix)
+    filepaths = []
+    for filepath in namelist:
+        if filepath.endswith(suffix) and filepath.startswith(prefix):
+            try:
+                year = int(filepath[start:start + 4])
+            except ValueError:
+                continue
+            if y0 <= year < y1:
+                filepaths.append(filepath)
+    return filepaths
 
 
 @log_timer
-def strip_archive(lang, ioformat='txt', years=(1900, 2050)):
+def strip_archive(lang, ioformat='txt', years=(1900, 2050), compression='stored'):
     """Method for xml-stripping an OpenSubtitles archive in zip format.
 
     Writes the xml-stripped archive directly to a zip format file.
+    XML parsing is fanned out over all cpu cores; reading from the input zip
+    and writing to the output zip stay in the main process because ZipFile
+    objects are not process-safe.
 
     :param lang: archive language
     :param ioformat: desired input/output format
     :param years: specific years to include in the output
+    :param compression: compression for the stripped archive ('stored' or 'deflated')
     """
     read_zip = zipfile.ZipFile(f'corpora/{lang}.zip', 'r')
-    write_zip = zipfile.ZipFile(f'corpora/{lang}_stripped.zip', 'a')
+    # the stripped archive is a pipeline intermediate that join_archive
+    # inflates right back, so it defaults to uncompressed storage; deflate
+    # level 1 is available when disk space matters more than cpu time
+    write_zip = zipfile.ZipFile(f'corpora/{lang}_stripped.zip', 'a',
+                                compression=zipfile.ZIP_STORED if compression == 'stored' else zipfile.ZIP_DEFLATED,
+                                compresslevel=1, allowZip64=True)
     if ioformat == 'txt':
         dirpath = 'OpenSubtitles/raw'
     elif ioformat in ['upos', 'lemma']:
         dirpath = 'OpenSubtitles/parsed'
-    filepaths = []
-    for filepath in read_zip.namelist():
-        if filepath.endswith('xml'):
-            if filepath.startswith(os.path.join(dirpath, lang)):
-                if int(filepath.split('/')[3]) in range(*years):
-                    filepaths.append(filepath)
+    filepaths = filter_filepaths(read_zip.namelist(), dirpath, lang, years, '.xml')
     logging.info(f'stripping xml from {len(filepaths)} subtitles in {lang}')
-    # XML parser recover option is needed to deal with malformed XML in subs
-    xmlparser = etree.XMLParser(recover=True, encoding='utf-8')
-    for filepath in sorted(filepaths):
-        write_zip.writestr(filepath.replace('xml', ioformat),
-                           strip_xml(read_zip.open(filepath).read(), xmlparser, ioformat))
+    max_workers = os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for filepath in filepaths:
+            # real OpenSubtitles dumps contain zero-byte members, which can't be parsed
+            if read_zip.getinfo(filepath).file_size == 0:
+                continue
+            with read_zip.open(filepath) as raw:
+                text = io.BufferedReader(raw, buffer_size=1 << 20).read()
+            pending.add(executor.submit(_strip_worker, filepath, text, ioformat))
+            # keep a bounded number of subtitles in flight so raw bytes don't pile up in memory
+            if len(pending) >= max_workers * 4:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    write_zip.writestr(*future.result())
+        for future in concurrent.futures.as_completed(pending):
+            write_zip.writestr(*future.result())
+
+
+# punctuation-stripping patterns, compiled once at import time
+# because strip_punctuation runs on every subtitle in the corpus
+# the removal rules run as their own first pass (inline tags sit between a
+# token and its punctuation all over OpenSubtitles text, so they have to be
+# gone before sentence breaking); the rewrite rules are fused into a single
+# second scan, and only the whitespace normalization still needs separate
+# passes over the (much smaller) result
+# the patterns run on decoded text: the two-character token minimum in the
+# sentence-break rule counts characters, not utf-8 bytes, and the whitespace
+# classes have to cover unicode spaces like nbsp, so bytes-mode regexes would
+# change the output for any non-ascii input
+PUNCT_DROP = re.compile(r'<.*?>|http.*?(?:[\s\n\]]|$)|\s\(.*?\)', re.IGNORECASE)  # xml tags, links, parentheticals
+PUNCT_SEP = re.compile(r"[-–—/']")  # replace hyphens, apostrophes and slashes with spaces
+PUNCT_FUSED = re.compile(
+    r'(?P<sent>[^\s]{2,})[\.\!\?\:\;]+?(?=[\s\n])'  # break sentences at periods
+    f'|(?P<sep>{PUNCT_SEP.pattern})'
+    r'|$',  # end-of-text sentence break
+    re.IGNORECASE)
+WS_NEWLINE = re.compile(r'\s*\n\s*')  # strip empty lines and lines containing whitespace
+WS_SPACES = re.compile(r'\s{2,}')  # strip excessive spaces
+
+
+def _punct_dispatch(match):
+    if match.group('sent') is not None:
+        # separators inside the sentence-final token still need rewriting
+        return PUNCT_SEP.sub(' ', match.group('sent')) + '\n'
+    if match.group('sep') is not None:
+        return ' '
+    return '\n'
+
+# final keep-filters: strip anything that is not a word character or whitespace,
+# keeping the underscores that separate words from tags in the lemma/upos formats
+KEEP_TAG = re.compile(r'[^\w\s]')
+KEEP_TXT = re.compile(r'[^\w\s]|_')
 
 
 def strip_punctuation(txt, ioformat='txt'):
@@ -115,37 +277,61 @@ def strip_punctuation(txt, ioformat='txt'):
     :param ioformat: desired input/output format
     :returns: punctuation-stripped text
     """
-    regeces = [
-        (r'<.*?>', ''),  # strip other xml tags
-        (r'http.*?(?:[\s\n\]]|$)', ''),  # strip links
-        (r'\s\(.*?\)', ''),  # remove everything in parentheses
-        (r'([^\s]{2,})[\.\!\?\:\;]+?[\s\n]|$', '\\1\n'),  # break sentences at periods
-        (r"[-–—/']", ' '),  # replace hyphens, apostrophes and slashes with spaces
-        (r'\s*\n\s*', '\n'),  # strip empty lines and lines containing whitespace
-        (r'\s{2,}', ' '),  # strip excessive spaces
-    ]
-    for regec in regeces:
-        pattern = re.compile(regec[0], re.IGNORECASE)
-        txt = pattern.sub(regec[1], txt)
-    if ioformat == 'txt':
-        txt = ''.join([letter for letter in txt if (letter.isalnum() or letter.isspace())])
-    elif ioformat in ['lemma', 'upos']:
-        txt = ''.join([letter for letter in txt if (letter.isalnum() or letter.isspace() or (letter == '_'))])
+    txt = PUNCT_DROP.sub('', txt)
+    txt = PUNCT_FUSED.sub(_punct_dispatch, txt)
+    txt = WS_NEWLINE.sub('\n', txt)
+    txt = WS_SPACES.sub(' ', txt)
+    if ioformat in ['lemma', 'upos']:
+        txt = KEEP_TAG.sub('', txt)
     else:
-        txt = ''.join([letter for letter in txt if (letter.isalnum() or letter.isspace())])
+        txt = KEEP_TXT.sub('', txt)
     return txt
 
 
+def strip_punctuation_bytes(data, ioformat='txt'):
+    """Method for stripping punctuation from a utf-8 encoded text corpus.
+
+    :param data: utf-8 bytes to be stripped of punctuation
+    :param ioformat: desired input/output format
+    :returns: punctuation-stripped utf-8 bytes
+    """
+    return strip_punctuation(data.decode('utf-8'), ioformat).encode('utf-8')
+
+
+def open_corpus_output(out_fname, compress='none'):
+    """Opens the joined-corpus output file, optionally through a fast compressor.
+
+    zstd and lz4 at low levels decompress several times faster than DEFLATE,
+    which pays off because the joined corpus is read back by the downstream
+    deduplication and counting steps. Both compressors are optional
+    dependencies and only imported when requested.
+
+    :param out_fname: output filename (an extension is appended when compressing)
+    :param compress: compression to apply ('none', 'zstd', or 'lz4')
+    :returns: writable binary file handle
+    """
+    if compress == 'zstd':
+        import zstandard
+        cctx = zstandard.ZstdCompressor(level=3, threads=-1)
+        return cctx.stream_writer(open(f'{out_fname}.zst', 'wb', buffering=1 << 20))
+    elif compress == 'lz4':
+        import lz4.frame
+        return lz4.frame.open(f'{out_fname}.lz4', 'wb')
+    else:
+        return open(out_fname, 'wb', buffering=1 << 20)
+
+
 @log_timer
-def join_archive(lang, ioformat='txt', years=(1900, 2050), verbose=False):
+def join_archive(lang, ioformat='txt', years=(1900, 2050), verbose=False, compress='none'):
     """Method for joining an OpenSubtitles archive into a single large txt file.
 
     Writes joined corpus directly to a txt file.
-    
+
     :param lang: corpus language
     :param ioformat: desired input/output format
     :param years: specific years to include in the output
     :param verbose: print progress bar or not
+    :param compress: compression to apply to the output ('none', 'zstd', or 'lz4')
     :returns: number of subtitle files in corpus
     """
     read_zip = zipfile.ZipFile(f'corpora/{lang}_stripped.zip', 'r')
@@ -154,18 +340,18 @@ def join_archive(lang, ioformat='txt', years=(1900, 2050), verbose=False):
         dirpath = 'OpenSubtitles/raw'
     elif ioformat in ['upos', 'lemma']:
         dirpath = 'OpenSubtitles/parsed'
-    filepaths = []
-    for filepath in read_zip.namelist():
-        if filepath.endswith(ioformat):
-            if filepath.startswith(os.path.join(dirpath, lang)):
-                if int(filepath.split('/')[3]) in range(*years):
-                    filepaths.append(filepath)
+    filepaths = filter_filepaths(read_zip.namelist(), dirpath, lang, years, '.' + ioformat)
     total = len(filepaths)
     logging.info(f'joining {len(filepaths)} subtitles in {lang} into a single file')
     i = 0
-    with open(out_fname, 'w') as outfile:
+    # binary output with a 1 MiB buffer keeps syscalls per subtitle to a minimum
+    with open_corpus_output(out_fname, compress) as outfile:
         for filepath in filepaths:
-                outfile.write(strip_punctuation(read_zip.open(filepath).read().decode('utf-8'), ioformat))
+                if read_zip.getinfo(filepath).file_size == 0:
+                    continue
+                with read_zip.open(filepath) as raw:
+                    data = io.BufferedReader(raw, buffer_size=1 << 20).read()
+                outfile.write(strip_punctuation_bytes(data, ioformat))
                 if verbose:
                     i += 1
                     print(f'\tprogress: {(float(i) / total) * 100:5.2f}%', end='\r')
@@ -181,9 +367,13 @@ if __name__ == '__main__':
     argparser.add_argument('--years', default=(1900, 2050), nargs=2, type=int, help='years of subtitles to include')
     argparser.add_argument('--join', action='store_true', help='join subtitles into one large txt file')
     argparser.add_argument('--ioformat', default='txt', choices=['txt', 'lemma', 'upos', 'viz'], help='input/output format')
+    argparser.add_argument('--compress', default='none', choices=['none', 'zstd', 'lz4'],
+                           help='compression to apply to the joined corpus (requires zstandard or lz4)')
+    argparser.add_argument('--intermediate-compression', default='stored', choices=['stored', 'deflated'],
+                           help='compression for the intermediate stripped archive')
     args = argparser.parse_args()
 
     if args.stripxml:
-        strip_archive(args.lang, args.ioformat, args.years)
+        strip_archive(args.lang, args.ioformat, args.years, args.intermediate_compression)
     if args.join:
-        join_archive(args.lang, args.ioformat, args.years)
+        join_archive(args.lang, args.ioformat, args.years, compress=args.compress)
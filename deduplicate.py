@@ -4,46 +4,82 @@ import os
 import lzma
 import argparse
 import random
-import itertools
+import hashlib
+import shutil
+import concurrent.futures
+import pandas as pd
 from utensils import log_timer
 import logging
 logging.basicConfig(format='[{levelname}] {message}', style='{', level=logging.INFO)
 
 
-def get_lines(fhandle):
-    """Removes duplicate lines from a file.
-
-    :param fhandle: file handle to get lines from
-    :returns: deduplicated lines, number of lines, number of duplicates removed
-    """
-    lines = fhandle.read().split('\n')
-    n_lines = len(lines)
-    lines = set(lines)
-    n_duplicates = n_lines - len(lines)
-    return lines, n_lines, n_duplicates
-
-
 @log_timer
 def dedup_file(in_fname, out_fname):
     """Deduplicates a file line-wise.
 
+    Streams the input line by line and keeps only a 16-byte blake2b
+    fingerprint per unique line, so peak memory scales with the number of
+    unique lines rather than the file size. Unique lines are spooled to a
+    temp file on the first pass and written out in shuffled order on the
+    second.
+
     :param in_fname: file to deduplicate
     :param out_fname: filename that deduplicated files will be written to
     :returns: number of lines, number of duplicates removed
     """
-    with open(in_fname, 'r') as in_file, open(out_fname, 'w') as out_file:
-        lines, n_lines, n_duplicates = get_lines(in_file)
-        lines = list(lines)
-        random.shuffle(lines)
-        out_file.write('\n'.join(lines))
+    tmp_fname = out_fname + '.tmp'
+    seen = set()
+    offsets = []
+    n_lines = 0
+    pos = 0
+    with open(in_fname, 'rb') as in_file, open(tmp_fname, 'wb', buffering=1 << 20) as tmp_file:
+        for line in in_file:
+            n_lines += 1
+            # normalize the (possibly newline-less) final line so shuffled
+            # output lines can't run together
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            fingerprint = hashlib.blake2b(line, digest_size=16).digest()
+            if fingerprint not in seen:
+                seen.add(fingerprint)
+                offsets.append((pos, len(line)))
+                pos += tmp_file.write(line)
+    n_duplicates = n_lines - len(offsets)
+    random.shuffle(offsets)
+    with open(tmp_fname, 'rb') as tmp_file, open(out_fname, 'wb', buffering=1 << 20) as out_file:
+        for offset, length in offsets:
+            tmp_file.seek(offset)
+            out_file.write(tmp_file.read(length))
+    os.remove(tmp_fname)
     logging.info(f'deduplicated {in_fname}, removed {n_duplicates} duplicates out of {n_lines} lines')
     return n_lines, n_duplicates
 
 
-# because of itertools.cycle() this is only pseudorandomized and pseudodeduplicated
-# (i.e.: consecutive lines input cannot end up as consecutive in the output
-# and up to n_bins duplicates of an item may remain)
-# unless your file fits into memory after deduplication (which includes randomization)
+def _dedup_bin(tmp_fname):
+    """Deduplicates and shuffles a single temp bin inside a worker process.
+
+    :param tmp_fname: temp bin to deduplicate
+    :returns: path of the deduplicated and shuffled bin
+    """
+    with open(tmp_fname, 'rb') as tempfile:
+        lines = pd.Series(tempfile.read().splitlines(keepends=True))
+    # bins fit in memory by construction, so dedup and shuffle can be
+    # vectorized: drop_duplicates and sample run in C instead of a
+    # Python-level set/shuffle loop
+    lines = lines.drop_duplicates().sample(frac=1)
+    dedup_fname = tmp_fname + '.dedup'
+    with open(dedup_fname, 'wb', buffering=1 << 20) as dedup_out:
+        # writelines streams through the 1 MiB buffer instead of
+        # materializing the whole bin as one joined bytes object
+        dedup_out.writelines(lines)
+    os.remove(tmp_fname)
+    return dedup_fname
+
+
+# because lines are distributed over bins by hash, identical lines always land
+# in the same bin and per-bin deduplication amounts to exact global deduplication
+# the output is still only pseudorandomized though (i.e.: lines are only shuffled
+# within their bin, not across the whole file)
 @log_timer
 def big_dedup_file(in_fname, out_fname, n_bins):
     """Method for line-wise deduplication of files too big to fit in memory.
@@ -52,24 +88,33 @@ def big_dedup_file(in_fname, out_fname, n_bins):
     :param out_fname: filename that deduplicated files will be written to
     :param n_bins: number of chunks to split big file into, more bins means less memory use
     """
-    filehandles = []
-    for i in range(n_bins):
-        filehandles.append(open(f'temp{i}.txt', 'w'))
-    handle_iter = itertools.cycle(filehandles)
-    with open(in_fname, 'r') as in_file:
+    # per-bin bytearray buffers are flushed in ~1 MiB chunks to unbuffered
+    # handles, instead of paying a Python-level write call per line
+    buffers = [bytearray() for _ in range(n_bins)]
+    filehandles = [open(f'temp{i}.txt', 'wb', buffering=0) for i in range(n_bins)]
+    with open(in_fname, 'rb') as in_file:
         for line in in_file:
-            next(handle_iter).write(line)
-    for filehandle in filehandles:
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            i = hash(line) % n_bins
+            buffers[i] += line
+            if len(buffers[i]) > 1 << 20:
+                filehandles[i].write(buffers[i])
+                buffers[i].clear()
+    for buffer, filehandle in zip(buffers, filehandles):
+        if buffer:
+            filehandle.write(buffer)
         filehandle.close()
 
-    with open(out_fname, 'w') as out_file:
-        for i in range(n_bins):
-            with open(f'temp{i}.txt', 'r') as tempfile:
-                # deduplicate
-                lines = list(set(tempfile.read().split('\n')))
-                random.shuffle(lines)
-                out_file.write('\n'.join(lines))
-    logging.info(f'pseudodeduplicated {in_fname}, {out_fname} is also pseudorandomized')
+    # bins are independent after hash partitioning, so dedup them in parallel
+    # and concatenate the finished bins into the output file as they come in
+    with open(out_fname, 'wb', buffering=1 << 20) as out_file:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(n_bins, os.cpu_count())) as executor:
+            for dedup_fname in executor.map(_dedup_bin, [f'temp{i}.txt' for i in range(n_bins)]):
+                with open(dedup_fname, 'rb') as dedup_bin:
+                    shutil.copyfileobj(dedup_bin, out_file, 1 << 20)
+                os.remove(dedup_fname)
+    logging.info(f'deduplicated {in_fname}, note that {out_fname} is only pseudorandomized')
 
 
 if __name__ == '__main__':
@@ -83,4 +128,4 @@ if __name__ == '__main__':
     if args.bins == 1:
         dedup_file(args.filename, os.path.join(path, 'dedup.' + filename))
     else:
-        big_dedup_file(args.filename, os.path.join(path, 'pseudodedup.' + filename), args.bins)
+        big_dedup_file(args.filename, os.path.join(path, 'dedup.' + filename), args.bins)
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+# jeroen.vanparidon@mpi.nl
+"""Builds the optional compiled fast path for clean_subs.
+
+Run `python setup.py build_ext --inplace` (requires Cython); the scripts work
+without it, clean_subs just falls back to its pure Python strippers.
+"""
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+    name='count-animal-colors',
+    ext_modules=cythonize('strip_fast.pyx'),
+)
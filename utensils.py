@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # jvparidon@gmail.com
-from time import time, localtime, strftime
+from functools import wraps
+from time import time, localtime, strftime, perf_counter_ns
 import logging
 logging.basicConfig(format='[{levelname}] {message}', style='{', level=logging.INFO)
 
@@ -32,15 +33,18 @@ def log_timer(func):
 
     Use by prepending @log_timer to the target function definition.
     Logs function name and duration in seconds to level INFO.
+    Durations come from the monotonic perf_counter_ns clock, so they are not
+    skewed by wall clock adjustments, and wraps preserves the decorated
+    function's metadata so it shows up under its own name in profilers.
 
     :param func: any function
     :return: func with logging timer
     """
+    @wraps(func)
     def timed_func(*args, **kwargs):
-        t0 = time()
+        t0 = perf_counter_ns()
         res = func(*args, **kwargs)
-        t1 = time()
-        t = t1 - t0
-        logging.info(f'{func} ran in {t:.3f} seconds')
+        t = (perf_counter_ns() - t0) / 1e9
+        logging.info(f'{func.__name__} ran in {t:.3f} seconds')
         return res
     return timed_func